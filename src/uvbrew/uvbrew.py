@@ -1,20 +1,35 @@
 import hashlib
 import logging
+import mmap
+import os
+import re
 import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import Generator
+from typing import TYPE_CHECKING, Generator
+from urllib.parse import parse_qs, urlparse
 
 import click
-import httpx
 import tomllib
 import structlog
 
+if TYPE_CHECKING:
+    import httpx
+
 logger: structlog.stdlib.BoundLogger = structlog.get_logger()
 mlog = logging.getLogger("uvbrew")
 mlog.setLevel(logging.INFO)
 
-@dataclass
+CHUNK_SIZE = 1 << 16
+
+RESOURCE_TMPL_WITH_SHA = '{i}resource "{name}" do\n{ii}url "{url}"\n{ii}sha256 "{sha}"\n{i}end\n'
+RESOURCE_TMPL_NO_SHA = '{i}resource "{name}" do\n{ii}url "{url}"\n{i}end\n'
+
+@dataclass(slots=True, frozen=True)
 class Meta:
     name: str
     version: str
@@ -24,25 +39,95 @@ class Meta:
     homepage: str | None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Package:
     name: str
     url: str
     sha256: str | None
 
-# from https://github.com/tdsmith/homebrew-pypi-poet/blob/fdafc615bcd28f29bcbe90789f07cc26f97c3bbc/poet/util.py#L1
+_STUDLY_RE = re.compile(r"(?:^|[-_])([^-_]?)")
+
+# same output as https://github.com/tdsmith/homebrew-pypi-poet/blob/fdafc615bcd28f29bcbe90789f07cc26f97c3bbc/poet/util.py#L1
 def dash_to_studly(s):
-    l = list(s)
-    l[0] = l[0].upper()
-    delims = "-_"
-    for i, c in enumerate(l):
-        if c in delims:
-            if (i+1) < len(l):
-                l[i+1] = l[i+1].upper()
-    out = "".join(l)
-    for d in delims:
-        out = out.replace(d, "")
-    return out
+    return _STUDLY_RE.sub(lambda m: m.group(1).upper(), s)
+
+_NORMALIZE_RE = re.compile(r"[-_.]+")
+
+_SHA256_RE = re.compile(r"[0-9a-f]{64}")
+
+def _httpx():
+    import httpx
+    return httpx
+
+def _sha256_file(path: Path) -> str:
+    with open(path, "rb") as f:
+        # mmap can't map an empty file
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+def _sha256_stream(r: "httpx.Response") -> str:
+    digest = hashlib.sha256()
+    for chunk in r.iter_bytes(chunk_size=CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def _cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "uvbrew"
+
+# custom indexes can re-upload a file under the same url, so key on size/etag too
+def _cache_key(client: "httpx.Client", url: str) -> str | None:
+    httpx = _httpx()
+
+    try:
+        r = client.head(url)
+    except httpx.HTTPError as e:
+        logger.debug("failed to fetch cache validators", url=url, error=str(e))
+        return None
+    if r.status_code != 200:
+        return None
+
+    content_length = r.headers.get("content-length", "")
+    etag = r.headers.get("etag", "")
+    if not content_length and not etag:
+        return None
+
+    return hashlib.sha256(f"{url}\n{content_length}\n{etag}".encode()).hexdigest()
+
+def _sha256_url(client: "httpx.Client", url: str) -> str:
+    fragment = parse_qs(urlparse(url).fragment).get("sha256", [])
+    if fragment and _SHA256_RE.fullmatch(fragment[0].lower()):
+        sha256 = fragment[0].lower()
+        logger.debug("using sha256 from url fragment", url=url, sha256=sha256)
+        return sha256
+
+    key = _cache_key(client, url)
+    path = _cache_dir() / "sha256" / key if key is not None else None
+    if path is not None:
+        try:
+            sha256 = path.read_text().strip()
+            if _SHA256_RE.fullmatch(sha256):
+                logger.debug("using cached sha256", url=url, sha256=sha256)
+                return sha256
+        except (OSError, ValueError):
+            pass
+
+    with client.stream("GET", url) as r:
+        r.raise_for_status()
+        sha256 = _sha256_stream(r)
+
+    if path is not None:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+            tmp.write_text(sha256)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.debug("failed to cache sha256", url=url, error=str(e))
+
+    return sha256
 
 def _packages(root: Path, skip_packages: set[str]) -> Generator[Package, None, None]:
     output = subprocess.check_output([
@@ -68,13 +153,33 @@ def _packages(root: Path, skip_packages: set[str]) -> Generator[Package, None, N
 
         yield Package(name=name, url=url, sha256=sha256)
 
+def _resolve(client: "httpx.Client", pkg: Package) -> Package:
+    if pkg.sha256 is not None:
+        return pkg
+
+    httpx = _httpx()
+
+    log = logger.bind(package=pkg.name, url=pkg.url)
+    log.debug("calculating sha256")
+    try:
+        sha256 = _sha256_url(client, pkg.url)
+    except (httpx.HTTPError, httpx.InvalidURL, httpx.StreamError) as e:
+        log.warning("failed to calculate sha256, emitting resource without it", error=str(e))
+        return pkg
+    log.debug("calculated sha256", sha256=sha256)
+
+    return Package(name=pkg.name, url=pkg.url, sha256=sha256)
+
+def _load_toml(path: Path) -> dict:
+    with path.open("rb") as f:
+        return tomllib.load(f)
+
 def _meta(root: Path) -> Meta:
     project_path = root / "pyproject.toml"
-    if not project_path.exists():
-        raise FileNotFoundError("pyproject.toml not found")
-
-    with project_path.open("rb") as f:
-        pyproject = tomllib.load(f)
+    try:
+        pyproject = _load_toml(project_path)
+    except FileNotFoundError:
+        raise FileNotFoundError("pyproject.toml not found") from None
 
     project = pyproject.get("project", {})
     name: str | None = project.get("name", None)
@@ -98,25 +203,58 @@ def _meta(root: Path) -> Meta:
 
     return Meta(name=name, version=version, requires_python=requires_python.removeprefix(">="), description=description, homepage=homepage)
 
-def _from_index(index_url: str | None, package: str, version: str) -> tuple[str, str] | None:
+def _normalize(name: str) -> str:
+    return _NORMALIZE_RE.sub("-", name).lower()
+
+def _from_lock(lock: dict, package: str, version: str) -> tuple[str, str] | None:
+    name = _normalize(package)
+    for entry in lock.get("package", []):
+        if entry.get("name") != name or entry.get("version") != version:
+            continue
+
+        # the project itself is usually an editable/virtual source with no sdist
+        sdist = entry.get("sdist", {})
+        url: str | None = sdist.get("url", None)
+        digest: str = sdist.get("hash", "")
+        if url and digest.startswith("sha256:"):
+            sha256 = digest.removeprefix("sha256:")
+            logger.debug("using sdist from uv.lock", package=package, version=version, url=url, sha256=sha256)
+            return url, sha256
+
+    return None
+
+def _from_dist(dist: Path) -> tuple[str, str] | None:
+    try:
+        sha256 = _sha256_file(dist)
+    except FileNotFoundError:
+        return None
+
+    logger.debug("using local dist", dist=str(dist), sha256=sha256)
+    return f"file://{dist.resolve()}", sha256
+
+def _from_index(client: "httpx.Client", index_url: str | None, package: str, version: str) -> tuple[str, str] | None:
     default_index = False
     if index_url is None:
         default_index = True
         index_url = "https://pypi.org/pypi"
 
     log = logger.bind(package=package, version=version, index_url=index_url)
-    r = httpx.get(f'{index_url}/{package}/json')
+    if default_index:
+        r = client.get(f'{index_url}/{package}/{version}/json')
+    else:
+        r = client.get(f'{index_url}/{package}/json')
     if r.status_code == 404:
-        log.warning(f"package not found")
+        log.warning("package or version not found" if default_index else "package not found")
 
         if not default_index:
-            r = httpx.get(f'{index_url}/{package}-{version}.tar.gz')
-            if r.status_code == 200:
-                sha256 = hashlib.sha256(r.content).hexdigest()
-                log.info("found package archive directly", sha256=sha256)
-                return str(r.url), sha256
+            archive_url = f'{index_url}/{package}-{version}.tar.gz'
+            try:
+                sha256 = _sha256_url(client, archive_url)
+            except _httpx().HTTPStatusError as e:
+                log.warning("package archive not found directly", status_code=e.response.status_code)
             else:
-                log.warning("package archive not found directly", status_code=r.status_code)
+                log.info("found package archive directly", sha256=sha256)
+                return archive_url, sha256
 
         return None
 
@@ -128,13 +266,18 @@ def _from_index(index_url: str | None, package: str, version: str) -> tuple[str,
     log.debug("package metadata fetched")
 
     data = r.json()
-    releases = data.get("releases", {})
+    if default_index:
+        files = data.get("urls", [])
+    else:
+        releases = data.get("releases", {})
 
-    if version not in releases:
-        log.warning("version not found")
-        return None
+        if version not in releases:
+            log.warning("version not found")
+            return None
 
-    for idx, file in enumerate(releases[version]):
+        files = releases[version]
+
+    for idx, file in enumerate(files):
         url: str = file.get("url", "")
         if not url:
             log.debug("ignoring release with no url", index=idx)
@@ -155,9 +298,7 @@ def _from_index(index_url: str | None, package: str, version: str) -> tuple[str,
         sha256: str = file.get("digests", {}).get("sha256", None)
         if sha256 is None:
             log.debug("calculating sha256", index=idx, url=url)
-            r = httpx.get(url)
-            r.raise_for_status()
-            sha256 = hashlib.sha256(r.content).hexdigest()
+            sha256 = _sha256_url(client, url)
             log.debug("calculated sha256", sha256=sha256)
 
         return url, sha256
@@ -172,70 +313,91 @@ def _from_index(index_url: str | None, package: str, version: str) -> tuple[str,
 @click.option(
     '--index-url', '-I', type=str, help='custom package index url. should either support the \'/json\' endpoint, or contain \'{package}-{version}.tar.gz\''
 )
+@click.option(
+    '--prefer-local', is_flag=True, help='use an existing local dist as a file:// url without checking the index'
+)
 @click.option(
     '-v', '--verbose', is_flag=True, help='enable verbose logging'
 )
-def cli(indent_length: int, index_url: str | None, verbose: bool):
+def cli(indent_length: int, index_url: str | None, prefer_local: bool, verbose: bool):
     if verbose:
         logger.setLevel(logging.DEBUG)
 
     root = Path()
     indent = " " * indent_length
+    indent2 = indent * 2
 
     lock_path = root / "uv.lock"
-    if not lock_path.exists():
+    try:
+        lock = _load_toml(lock_path)
+    except FileNotFoundError:
         click.echo("No uv.lock file found. Are you in a uv managed project?")
         raise click.Abort()
 
     meta = _meta(root)
     class_name = dash_to_studly(meta.name)
-    print(f"class {class_name} < Formula")
-    print(indent + f'include Language::Python::Virtualenv')
-    print()
+    lines: list[str] = []
+    lines.append(f"class {class_name} < Formula")
+    lines.append(indent + f'include Language::Python::Virtualenv')
+    lines.append("")
 
     if meta.description:
-        print(indent + f"desc \"{meta.description}\"")
+        lines.append(indent + f"desc \"{meta.description}\"")
     if meta.homepage:
-        print(indent + f"homepage \"{meta.homepage}\"")
+        lines.append(indent + f"homepage \"{meta.homepage}\"")
 
     dist = root / "dist" / f"{meta.name}-{meta.version}.tar.gz"
 
-    url, sha256 = _from_index(index_url, meta.name, meta.version) or (None, None)
-    if not url:
-        if not dist.exists():
-            logger.info("building dist", root=root)
-            subprocess.check_output(["uv", "build"], cwd=root)
-            if not dist.exists():
-                raise FileNotFoundError(f"dist file not found after build: {dist}")
-
-        url = f"file://{dist.resolve()}"
-        digest = hashlib.sha256()
-        with open(dist, "rb") as f:
-            digest.update(f.read())
-        sha256 = digest.hexdigest()
-
-    print(indent + f"url \"{url}\"")
-    print(indent + f"sha256 \"{sha256}\"")
-    print()
-
-    print(indent + f"depends_on \"python@{meta.requires_python}\"")
-    print()
-
-    for pkg in _packages(root, {meta.name}):
-        print(indent + f"resource \"{pkg.name}\" do")
-        print(indent*2 + f"url \"{pkg.url}\"")
-        if pkg.sha256:
-            print(indent*2 + f"sha256 \"{pkg.sha256}\"")
-        print(indent + "end")
-        print()
-
-    print(indent + "def install")
-    print(indent*2 + "virtualenv_install_with_resources")
-    print(indent + "end")
-    print()
-
-    print(indent + "test do")
-    print(indent*2 + f"system \"{meta.name}\", \"--version\"")
-    print(indent + "end")
-
-    print("end")
+    httpx = _httpx()
+
+    with (
+        httpx.Client(timeout=30.0, headers={"user-agent": "uvbrew"}) as client,
+        ThreadPoolExecutor(max_workers=16) as executor,
+    ):
+        exported = executor.submit(list, _packages(root, {meta.name}))
+
+        url, sha256 = (
+            _from_lock(lock, meta.name, meta.version)
+            or (_from_dist(dist) if prefer_local else None)
+            or _from_index(client, index_url, meta.name, meta.version)
+            or (None, None)
+        )
+
+        # don't run uv build alongside uv export
+        exported_packages = exported.result()
+        if not url:
+            found = _from_dist(dist)
+            if found is None:
+                logger.info("building dist", root=root)
+                subprocess.check_output(["uv", "build"], cwd=root)
+                found = _from_dist(dist)
+                if found is None:
+                    raise FileNotFoundError(f"dist file not found after build: {dist}")
+
+            url, sha256 = found
+
+        packages = list(executor.map(partial(_resolve, client), exported_packages))
+
+    lines.append(indent + f"url \"{url}\"")
+    lines.append(indent + f"sha256 \"{sha256}\"")
+    lines.append("")
+
+    lines.append(indent + f"depends_on \"python@{meta.requires_python}\"")
+    lines.append("")
+
+    for pkg in packages:
+        tmpl = RESOURCE_TMPL_WITH_SHA if pkg.sha256 else RESOURCE_TMPL_NO_SHA
+        lines.append(tmpl.format(i=indent, ii=indent2, name=pkg.name, url=pkg.url, sha=pkg.sha256))
+
+    lines.append(indent + "def install")
+    lines.append(indent2 + "virtualenv_install_with_resources")
+    lines.append(indent + "end")
+    lines.append("")
+
+    lines.append(indent + "test do")
+    lines.append(indent2 + f"system \"{meta.name}\", \"--version\"")
+    lines.append(indent + "end")
+
+    lines.append("end")
+
+    sys.stdout.write("\n".join(lines) + "\n")